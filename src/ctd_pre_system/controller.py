@@ -1,3 +1,4 @@
+import contextlib
 import datetime
 import os
 import subprocess
@@ -5,7 +6,6 @@ import threading
 from pathlib import Path
 
 import file_explorer
-import psutil
 from file_explorer import psa
 from file_explorer import seabird
 from file_explorer.seabird import paths
@@ -16,12 +16,6 @@ from ctd_pre_system.station import Stations
 from ctd_pre_system import auto_fire
 from ctd_pre_system import exceptions
 
-svepa = None
-try:
-    import svepa
-except ImportError:
-    pass
-
 
 class Controller:
 
@@ -40,6 +34,9 @@ class Controller:
         self.auto_fire_bottle_order = auto_fire.get_bottle_order_object()
 
         self._seasave_psa = None
+        self._xmlcon_cache = {}
+        self._package_collection_cache = None
+        self._file_stem_parts_cache = {}
 
     @property
     def seasave_psa(self):
@@ -73,7 +70,9 @@ class Controller:
         self._paths.set_server_root_directory(directory)
 
     def get_svepa_info(self, credentials_path):
-        if not svepa:
+        try:
+            import svepa
+        except ImportError:
             return {}
         info = svepa.get_current_station_info(path_to_svepa_credentials=credentials_path)
         return info
@@ -93,14 +92,16 @@ class Controller:
     def get_distance_to_station(self, lat, lon, station_name):
         return self.stations.get_distance_to_station(lat, lon, station_name)
 
-    def _get_running_programs(self):
-        program_list = []
-        for p in psutil.process_iter():
-            program_list.append(p.name())
-        return program_list
+    def _is_program_running(self, name):
+        import psutil
+        name = name.lower()
+        for p in psutil.process_iter(['name']):
+            if (p.info['name'] or '').lower() == name:
+                return True
+        return False
 
     def run_seasave(self):
-        if 'Seasave.exe' in self._get_running_programs():
+        if self._is_program_running('Seasave.exe'):
             # filezilla.exe
             raise ChildProcessError('Seasave is already running!')
 
@@ -124,8 +125,16 @@ class Controller:
         return self.ctd_config.seasave_psa_main_file
 
     def _get_xmlcon_object(self, instrument):
+        """Parsed xmlcon files are cached and reparsed only if the file has been modified"""
         xmlcon_file_path = self.get_xmlcon_path(instrument)
+        stat = os.stat(xmlcon_file_path)
+        # Size is included since timestamps can be coarse on network and FAT shares
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self._xmlcon_cache.get(xmlcon_file_path)
+        if cached and cached[0] == version:
+            return cached[1]
         obj = seabird.XmlconFile(xmlcon_file_path, ignore_pattern=True)
+        self._xmlcon_cache[xmlcon_file_path] = (version, obj)
         return obj
 
     def _get_main_psa_object(self) -> psa.SeasavePSAfile:
@@ -164,7 +173,8 @@ class Controller:
         if instrument:
             self._instrument = instrument
             print('INSTRUMENT', instrument)
-            self.update_xmlcon_in_main_psa_file(instrument)
+            # Saved together with the rest of the attributes below
+            self.seasave_psa.xmlcon_path = self.get_xmlcon_path(instrument)
             
 
         if self.series_exists(
@@ -182,10 +192,8 @@ class Controller:
                                                 cruise=cruise_nr,
                                                 ship=ship_code,
                                                 serno=serno,
-                                                tail=tail)
-        directory = hex_file_path.parent
-        if not directory.exists():
-            os.makedirs(directory)
+                                                tail=tail,
+                                                create_directory=True)
 
         # psa_obj = self._get_main_psa_object()
         self.seasave_psa.data_path = hex_file_path
@@ -221,7 +229,8 @@ class Controller:
 
         self.seasave_psa.save()
 
-    def get_data_file_path(self, instrument=None, cruise=None, ship=None, serno=None, tail=None):
+    def get_data_file_path(self, instrument=None, cruise=None, ship=None, serno=None, tail=None,
+                           create_directory=False):
         missing = []
         for key, value in zip(['instrument', 'cruise', 'ship', 'serno'], [instrument, cruise, ship, serno]):
             if not value:
@@ -230,24 +239,28 @@ class Controller:
             raise ValueError(f'Missing information: {str(missing)}')
         # Builds the file stem to be as the name for the processed file.
         # sbe09_1387_20200207_0801_77SE_0120
-        now = datetime.datetime.now()
-        time_str = now.strftime('%Y%m%d_%H%M')
-        year = str(now.year)
-
-        file_stem = '_'.join([
-            instrument,
-            self.get_instrument_serial_number(instrument),
-            time_str,
-            self.ships.get_code(ship),
-            cruise.zfill(2),
-            serno
-        ])
+        time_str = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+        instrument_part, ship_code = self._get_file_stem_parts(instrument, ship)
+
+        file_stem = f'{instrument_part}_{time_str}_{ship_code}_{cruise.zfill(2)}_{serno}'
         if tail:
             file_stem = f'{file_stem}_{tail}'
-        directory = self._paths.get_local_directory('source')
-        file_path = Path(directory, f'{file_stem}.hex')
+        directory = Path(self._paths.get_local_directory('source'))
+        if create_directory:
+            os.makedirs(directory, exist_ok=True)
+        file_path = directory / f'{file_stem}.hex'
         return file_path
 
+    def _get_file_stem_parts(self, instrument, ship):
+        """Parts of the file stem that are fixed for an instrument and ship. Cached until the xmlcon file changes"""
+        xmlcon = self._get_xmlcon_object(instrument)
+        cached = self._file_stem_parts_cache.get((instrument, ship))
+        if cached and cached[0] is xmlcon:
+            return cached[1]
+        parts = (f'{instrument}_{xmlcon.instrument_number}', self.ships.get_code(ship))
+        self._file_stem_parts_cache[(instrument, ship)] = (xmlcon, parts)
+        return parts
+
     def get_sensor_info_in_xmlcon(self, instrument):
         xmlcon = self._get_xmlcon_object(instrument)
         return xmlcon.sensor_info
@@ -271,6 +284,29 @@ class Controller:
         else:
             return self._paths.get_local_directory('raw', year=year, **kwargs)
 
+    @contextlib.contextmanager
+    def cached_package_collections(self):
+        """
+        Local directories are scanned only once within the with-block, e.g. when
+        calling series_exists and get_next_serno back to back. Server directories are
+        always scanned. Nested blocks share the cache of the outermost block.
+        """
+        previous = self._package_collection_cache
+        if previous is None:
+            self._package_collection_cache = {}
+        try:
+            yield
+        finally:
+            self._package_collection_cache = previous
+
+    def _get_package_collection(self, root_path, server=False):
+        if server or self._package_collection_cache is None:
+            return file_explorer.get_package_collection_for_directory(root_path)
+        key = str(root_path)
+        if key not in self._package_collection_cache:
+            self._package_collection_cache[key] = file_explorer.get_package_collection_for_directory(root_path)
+        return self._package_collection_cache[key]
+
     def series_exists(self, return_file_name=False, server=False, **kwargs):
         root_path = None
         if kwargs.get('source_dir'):
@@ -279,7 +315,7 @@ class Controller:
             root_path = self._get_raw_data_path(server=server, year=kwargs.get('year'), create=True)
         if not root_path:
             return False
-        pack_col = file_explorer.get_package_collection_for_directory(root_path)
+        pack_col = self._get_package_collection(root_path, server=server)
         if kwargs.get('check_serno'):
             return pack_col.series_exists(serno=kwargs.get('serno'))
         else:
@@ -290,14 +326,14 @@ class Controller:
 
     def get_latest_serno(self, server=False, **kwargs):
         root_path = self._get_raw_data_path(server=server, year=kwargs.get('year'), create=True)
-        pack_col = file_explorer.get_package_collection_for_directory(root_path)
+        pack_col = self._get_package_collection(root_path, server=server)
         return pack_col.get_latest_serno(**kwargs)
         # ctd_files_obj = get_ctd_files_object(root_path, suffix='.hex')
         # return ctd_files_obj.get_latest_serno(**kwargs)
 
     def get_latest_series_path(self, server=False, **kwargs):
         root_path = self._get_raw_data_path(server=server, year=kwargs.get('year'), create=True)
-        pack_col = file_explorer.get_package_collection_for_directory(root_path)
+        pack_col = self._get_package_collection(root_path, server=server)
         latest_pack = pack_col.get_latest_series(**kwargs)
         if not latest_pack:
             return
@@ -308,7 +344,7 @@ class Controller:
 
     def get_next_serno(self, server=False, **kwargs):
         root_path = self._get_raw_data_path(server=server, year=kwargs.get('year'), create=True)
-        pack_col = file_explorer.get_package_collection_for_directory(root_path)
+        pack_col = self._get_package_collection(root_path, server=server)
         return pack_col.get_next_serno(**kwargs)
         # ctd_files_obj = get_ctd_files_object(root_path, suffix='.hex')
         # return ctd_files_obj.get_next_serno(**kwargs)
@@ -1,8 +1,11 @@
+import importlib.util
+import os
+import threading
+from functools import lru_cache
 from pathlib import Path
 
-import requests
-
 from ctd_pre_system.resource import Resources
+from ctd_pre_system import utils
 
 import math
 import numpy as np
@@ -10,8 +13,13 @@ import pandas as pd
 
 import logging
 
+# pyarrow is imported by pandas when used as csv engine
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
 logger = logging.getLogger(__name__)
 
+EARTH_RADIUS = 6371 * 1000  # Mean radius of the earth (km) * 1000 m
+
 
 class StationMethods:
     def get_closest_station(self, *args, **kwargs):
@@ -20,6 +28,9 @@ class StationMethods:
     def get_proper_station_name(self, *args, **kwargs):
         raise NotImplementedError
 
+    def has_station(self, *args, **kwargs):
+        raise NotImplementedError
+
     def get_station_info(self, *args, **kwargs):
         raise NotImplementedError
 
@@ -39,12 +50,31 @@ class StationsMatprogram(StationMethods):
         update_primary = kwargs.get('update_primary')
         if update_primary is None:
             update_primary = self._resources.update_primary_station_file
-        self._station_file = StationFile(backup_file_path=self._resources.backup_station_file,
-                                         primary_url=self._resources.primary_station_file_url,
-                                         primary_encoding=self._resources.primary_station_file_url_encoding,
-                                         backup_encoding=self._resources.backup_station_file_encoding,
-                                         **kwargs)
-        self._load_station_filter_file()
+        self._station_file = None
+        self._init_exception = None
+        self._initialized = threading.Event()
+        # Download and loading of the station file is done in the background
+        t = threading.Thread(target=self._init_station_file, kwargs=kwargs)
+        t.daemon = True
+        t.start()
+
+    def _init_station_file(self, **kwargs):
+        try:
+            self._station_file = StationFile(backup_file_path=self._resources.backup_station_file,
+                                             primary_url=self._resources.primary_station_file_url,
+                                             primary_encoding=self._resources.primary_station_file_url_encoding,
+                                             backup_encoding=self._resources.backup_station_file_encoding,
+                                             **kwargs)
+            self._load_station_filter_file()
+        except Exception as e:
+            self._init_exception = e
+        finally:
+            self._initialized.set()
+
+    def _wait_for_station_file(self):
+        self._initialized.wait()
+        if self._init_exception:
+            raise self._init_exception
 
     def _load_station_filter_file(self):
         self.station_name_list = []
@@ -53,25 +83,34 @@ class StationsMatprogram(StationMethods):
                 name = line.split('\t')[0].strip()
                 if not name:
                     continue
-                if not self._station_file.get_station_info(name):
+                if not self._station_file.has_station(name):
                     print(f'Could not find station info for station: {name}')
                     continue
-                self.station_name_list.append(name)
-        self.station_name_list.sort()
+                self.station_name_list.append(self._station_file.get_proper_station_name(name))
+        self.station_name_list = sorted(set(self.station_name_list))
 
     def get_closest_station(self, *args, **kwargs):
+        self._wait_for_station_file()
         return self._station_file.get_closest_station(*args, *kwargs)
     
     def get_distance_to_station(self, *args, **kwargs):
+        self._wait_for_station_file()
         return self._station_file.get_distance_to_station(*args, **kwargs)
 
     def get_proper_station_name(self, *args, **kwargs):
+        self._wait_for_station_file()
         return self._station_file.get_proper_station_name(*args, *kwargs)
 
+    def has_station(self, *args, **kwargs):
+        self._wait_for_station_file()
+        return self._station_file.has_station(*args, **kwargs)
+
     def get_station_info(self, *args, **kwargs):
+        self._wait_for_station_file()
         return self._station_file.get_station_info(*args, *kwargs)
 
     def get_station_list(self, *args, **kwargs):
+        self._wait_for_station_file()
         return self.station_name_list
 
     def get_position(self, *args, **kwargs):
@@ -85,14 +124,19 @@ class StationFile(StationMethods):
         # kwargs['update_primary'] = True
 
         self._primary_file_path = None
+        self._primary_validators_path = None
         self._primary_url = primary_url
         if primary_url:
             self._primary_file_path = Path(Path(__file__).parent, 'resources', Path(primary_url).name)
+            # ETag and Last-Modified from the server response that gave the primary file
+            self._primary_validators_path = self._primary_file_path.with_name(
+                f'{self._primary_file_path.stem}_validators.json')
         self._backup_file_path = None
         if backup_file_path:
             self._backup_file_path = Path(backup_file_path)
 
         self._station_synonyms = {}
+        self._proper_station_name_cache = None
 
         self._primary_encoding = kwargs.get('primary_encoding', 'cp1252')
         self._backup_encoding = kwargs.get('backup_encoding', 'cp1252')
@@ -105,6 +149,16 @@ class StationFile(StationMethods):
         self.station_col = 'STATION_NAME'
 
         self._df = None
+        self._lat = None
+        self._lon = None
+        self._depth = None
+        self._radius = None
+        self._names = None
+        self._name_to_idx = {}
+        self._columns = {}
+        self._lat_rad = None
+        self._lon_rad = None
+        self._xyz = None
         if kwargs.get('update_primary'):
             self._download_station_file_from_git()
         self._load_file()
@@ -112,13 +166,47 @@ class StationFile(StationMethods):
     def _download_station_file_from_git(self):
         if not self._primary_url:
             return
-        response = requests.get(self._primary_url)
-        logger.debug(f'Setting response encoding to: {self._primary_encoding}')
-        response.encoding = self._primary_encoding
-        with open(self._primary_file_path, 'w', encoding=self._primary_encoding) as fid:
-            fid.write(response.text)
+        import requests
+        headers = {}
+        if self._primary_file_path.exists():
+            validators = self._load_primary_validators()
+            if validators.get('ETag'):
+                headers['If-None-Match'] = validators['ETag']
+            if validators.get('Last-Modified'):
+                headers['If-Modified-Since'] = validators['Last-Modified']
+        with requests.get(self._primary_url, headers=headers, stream=True) as response:
+            if response.status_code == 304:
+                logger.info('Primary station file in ctd_pre_system is up to date')
+                return
+            if response.status_code != 200:
+                logger.warning(f'Could not update primary station file. Status code: {response.status_code}')
+                return
+            # Bytes are written as is. The primary file has the same encoding as the source
+            tmp_file_path = self._primary_file_path.with_suffix('.tmp')
+            try:
+                with open(tmp_file_path, 'wb') as fid:
+                    for chunk in response.iter_content(64 * 1024):
+                        fid.write(chunk)
+            except Exception:
+                tmp_file_path.unlink(missing_ok=True)
+                raise
+            os.replace(tmp_file_path, self._primary_file_path)
+            self._save_primary_validators({key: response.headers[key] for key in ['ETag', 'Last-Modified']
+                                           if key in response.headers})
         logger.info(f'Primary station file updated in ctd_pre_system')
 
+    def _load_primary_validators(self):
+        if not self._primary_validators_path.exists():
+            return {}
+        try:
+            return utils.load_json(self._primary_validators_path)
+        except ValueError:
+            logger.warning(f'Could not read {self._primary_validators_path}')
+            return {}
+
+    def _save_primary_validators(self, validators):
+        utils.save_json(validators, self._primary_validators_path)
+
     def _load_file(self):
         print('self._primary_file_path', self._primary_file_path)
         if self._primary_file_path and self._primary_file_path.exists():
@@ -132,43 +220,70 @@ class StationFile(StationMethods):
         else:
             raise FileNotFoundError('Could not find station file in ctd_pre_system')
         print('file_path', file_path)
-        self._df = pd.read_csv(file_path, sep='\t', encoding=encoding)
+        self._df = pd.read_csv(file_path,
+                               sep='\t',
+                               encoding=encoding,
+                               engine='pyarrow' if HAS_PYARROW else 'c',
+                               usecols=[self.station_col, self.lat_col, self.lon_col, self.depth_col,
+                                        'MEDIA', 'SYNONYM_NAMES', 'OUT_OF_BOUNDS_RADIUS'],
+                               dtype={self.station_col: 'string',
+                                      'SYNONYM_NAMES': 'string',
+                                      'MEDIA': 'string',
+                                      self.lat_col: 'float64',
+                                      self.lon_col: 'float64',
+                                      'OUT_OF_BOUNDS_RADIUS': 'Int64'})
         self._df['MEDIA'] = self._df['MEDIA'].fillna('')
+        self._df['SYNONYM_NAMES'] = self._df['SYNONYM_NAMES'].fillna('')
         self._df[self.depth_col] = self._df[self.depth_col].fillna('')
+        # Column arrays and a name index for fast station info lookups
+        self._lat = self._df[self.lat_col].to_numpy(float)
+        self._lon = self._df[self.lon_col].to_numpy(float)
+        self._depth = self._df[self.depth_col].astype(str).to_numpy()
+        self._radius = self._df['OUT_OF_BOUNDS_RADIUS'].to_numpy(float, na_value=np.nan)
+        self._names = self._df[self.station_col].to_numpy()
+        self._name_to_idx = {name: i for i, name in enumerate(self._names)}
+        self._columns = {col: self._df[col].tolist() for col in self._df.columns}
+        # Positions in radians are cached for the vectorized closest station search
+        self._lat_rad = decmin_to_decdeg(self._lat) * math.pi / 180
+        self._lon_rad = decmin_to_decdeg(self._lon) * math.pi / 180
+        self._xyz = _unit_vector(self._lat_rad, self._lon_rad)
+        self._create_station_synonyms()
         # self._df = self._df[self._df['MEDIA'].str.contains('Vatten')].reset_index()
 
     def _create_station_synonyms(self):
-        for name, synonym_string in zip(self._df[self.station_col], self._df['SYNONYM_NAMES'].astype(str)):
-            self._station_synonyms[name.upper()] = name
-            synonym_string = synonym_string.strip()
-            if not synonym_string:
-                continue
-            synonyms = synonym_string.split('<or>')
-            for syn in synonyms:
-                self._station_synonyms[syn.upper()] = name
-
-    def _add_cols_to_station_info(self, station_info):
-        station_info['lat'] = station_info[self.lat_col]
-        station_info['lon'] = station_info[self.lon_col]
-        station_info['depth'] = str(station_info[self.depth_col])
-        station_info['station'] = station_info[self.station_col]
+        names = self._df[self.station_col]
+        synonyms = self._df['SYNONYM_NAMES'].fillna('').astype(str).str.strip()
+        base = dict(zip(names.str.upper(), names))
+        syn_df = pd.DataFrame({'name': names, 'syn': synonyms.str.split('<or>')}).explode('syn')
+        syn_df = syn_df[syn_df['syn'] != '']
+        extra = dict(zip(syn_df['syn'].str.upper().str.strip(), syn_df['name']))
+        # Proper station names take precedence over synonyms
+        self._station_synonyms = {**extra, **base}
+        self._proper_station_name_cache = lru_cache(maxsize=4096)(self._lookup_proper_station_name)
+
+    def _lookup_proper_station_name(self, synonym):
+        return self._station_synonyms.get(synonym.strip().upper(), None)
+
+    def _station_info(self, idx):
+        station_info = {col: values[idx] for col, values in self._columns.items()}
+        station_info['lat'] = float(self._lat[idx])
+        station_info['lon'] = float(self._lon[idx])
+        station_info['depth'] = self._depth[idx]
+        station_info['station'] = self._names[idx]
+        return station_info
 
     def get_closest_station(self, lat, lon):
         if lat is None or lon is None:
             return None
-        dist = self._df.apply(lambda x: distance_to_station((lat, lon),
-                                                           (x[self.lat_col],
-                                                            x[self.lon_col])), axis=1)
-        min_dist = min(dist)
-        index = np.where(dist == min_dist)
-        # print('LAT', lat)
-        # print('LON', lon)
-        # print('INDEX', index)
-        df = self._df.loc[index[0]]
-        station_info = dict(zip(df.columns, df.values[0]))
+        lat_rad = decmin_to_decdeg(float(lat)) * math.pi / 180
+        lon_rad = decmin_to_decdeg(float(lon)) * math.pi / 180
+        # The closest station has the largest dot product between unit vectors
+        cos_c = self._xyz @ _unit_vector(lat_rad, lon_rad).ravel()
+        index = int(cos_c.argmax())
+        min_dist = round(np.arccos(np.clip(cos_c[index], -1, 1)) * EARTH_RADIUS)
+        station_info = self._station_info(index)
         station_info['distance'] = min_dist
-        station_info['acceptable'] = min_dist <= station_info['OUT_OF_BOUNDS_RADIUS']
-        self._add_cols_to_station_info(station_info)
+        station_info['acceptable'] = bool(min_dist <= self._radius[index])
         return station_info
     
     def get_distance_to_station(self, lat, lon, station_name):
@@ -184,18 +299,21 @@ class StationFile(StationMethods):
         :param synonym: str
         :return:
         """
-        synonym = synonym.strip().upper()
-        if not self._station_synonyms:
-            self._create_station_synonyms()
-        return self._station_synonyms.get(synonym, None)
+        return self._proper_station_name_cache(synonym)
+
+    def has_station(self, station_name):
+        """
+        Returns True if "station_name" is a station name or synonym in the station file.
+        :param station_name: str
+        :return: bool
+        """
+        return station_name.strip().upper() in self._station_synonyms
 
     def get_station_info(self, station_name):
         name = self.get_proper_station_name(station_name)
         if not name:
             return None
-        station_info = self._df.loc[self._df['STATION_NAME'] == name].iloc[0].to_dict()
-        self._add_cols_to_station_info(station_info)
-        return station_info
+        return self._station_info(self._name_to_idx[name])
 
     def get_station_list(self):
         return sorted(self._df['STATION_NAME'])
@@ -218,57 +336,60 @@ def is_sequence(arg):
             hasattr(arg, "__iter__"))
 
 def decmin_to_decdeg(pos, return_string=False):
-    try:
-        if is_sequence(pos):
-            output = []
-            for p in pos:
-                p = float(p)
-                if p >= 0:
-                    output.append(np.floor(p / 100.) + (p % 100) / 60.)
-                else:
-                    output.append(np.ceil(p / 100.) - (-p % 100) / 60.)
-        else:
-            pos = float(pos)
-            if pos >= 0:
-                output = np.floor(pos / 100.) + (pos % 100) / 60.
-            else:
-                output = np.ceil(pos / 100.) - (-pos % 100) / 60.
-
-        if return_string:
-            if is_sequence(output):
-                return list(map(str, output))
-            else:
-                return str(output)
+    """
+    Converts position(s) in degrees and decimal minutes to decimal degrees.
+    Numpy arrays are converted in one vectorized operation.
+    """
+    if isinstance(pos, np.ndarray) or is_sequence(pos):
+        arr = np.asarray(pos, dtype=float)
+        abs_arr = np.abs(arr)
+        output = np.copysign(np.floor(abs_arr / 100.) + (abs_arr % 100) / 60., arr)
+        if not isinstance(pos, np.ndarray):
+            output = list(output)
+    else:
+        pos = float(pos)
+        abs_pos = abs(pos)
+        output = math.copysign(math.floor(abs_pos / 100.) + (abs_pos % 100) / 60., pos)
+
+    if return_string:
+        if is_sequence(output):
+            return list(map(str, output))
         else:
-            return output
-    except:
-        return pos
+            return str(output)
+    else:
+        return output
 
 
-def distance_to_station(pos1, pos2):
+def _unit_vector(lat_rad, lon_rad):
+    """Cartesian unit vectors, one row per position given in radians"""
+    cos_lat = np.cos(lat_rad)
+    return np.column_stack([cos_lat * np.cos(lon_rad), cos_lat * np.sin(lon_rad), np.sin(lat_rad)])
+
+
+def _hav_m(lat1, lon1, lat2, lon2):
     """
-    http://www.johndcook.com/blog/python_longitude_latitude/
-    Returns distance in meters
+    Haversine formula on the numerically stable atan2 form.
+    Positions in decimal degrees. Returns distance in meters
     """
-    lat1, lon1 = map(decmin_to_decdeg, pos1)
-    lat2, lon2 = map(decmin_to_decdeg, pos2)
-    if lat1 == lat2 and lon1 == lon2:
-        return 0
     degrees_to_radians = math.pi / 180.0
 
-    phi1 = (90.0 - lat1) * degrees_to_radians
-    phi2 = (90.0 - lat2) * degrees_to_radians
+    dphi = (lat2 - lat1) * degrees_to_radians / 2
+    dlam = (lon2 - lon1) * degrees_to_radians / 2
 
-    theta1 = lon1 * degrees_to_radians
-    theta2 = lon2 * degrees_to_radians
+    a = (math.sin(dphi) ** 2 +
+         math.cos(lat1 * degrees_to_radians) * math.cos(lat2 * degrees_to_radians) * math.sin(dlam) ** 2)
 
-    cos = (math.sin(phi1) * math.sin(phi2) * math.cos(theta1 - theta2) +
-           math.cos(phi1) * math.cos(phi2))
+    return 2 * EARTH_RADIUS * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
-    # distance = math.acos(cos) * 6373 * 1000  # 6373 ~ radius of the earth (km) * 1000 m
-    distance = math.acos(cos) * 6363 * 1000  # 6373 ~ radius of the earth (km) * 1000 m
 
-    return round(distance)
+def distance_to_station(pos1, pos2):
+    """
+    Positions in degrees and decimal minutes.
+    Returns distance in meters
+    """
+    lat1, lon1 = map(decmin_to_decdeg, pos1)
+    lat2, lon2 = map(decmin_to_decdeg, pos2)
+    return round(_hav_m(float(lat1), float(lon1), float(lat2), float(lon2)))
 
 
 if __name__ == '__main__':